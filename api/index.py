@@ -3,17 +3,34 @@ import boto3
 import time
 import csv
 import io
+import itertools
 import requests
 import json
 import datetime
-import stripe
 import logging
-from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, send_from_directory, session
+import threading
+import types
+import hashlib
+import gzip
+import base64
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps, lru_cache
+from urllib.parse import urlencode, urlparse
+from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, send_from_directory
 from flask_login import LoginManager, current_user, login_required, login_user, logout_user, UserMixin
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import load_only, raiseload
+from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Reduce AWS SDK logging noise
 logging.getLogger('botocore').setLevel(logging.WARNING)
@@ -24,19 +41,142 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 db = SQLAlchemy()
 login_manager = LoginManager()
 
+# Shared HTTP session for Google OAuth calls (keeps TLS connections alive between logins).
+# Retries cover idempotent GETs only (discovery, userinfo); the token POST is never replayed.
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=20,
+                                           max_retries=Retry(total=2, backoff_factor=0.1,
+                                                             status_forcelist=(502, 503, 504),
+                                                             raise_on_status=False)))
+HTTP_TIMEOUT = 5  # seconds
+
+TEXTRACT_PAGE_SIZE = 1000  # Largest MaxResults Textract accepts per page
+
+JOB_TOKEN_MAX_AGE = 3600  # seconds a status-poll token stays valid
+DIRECT_UPLOAD_EXPIRES = 300  # seconds a presigned browser-to-S3 POST stays valid
+UPLOAD_TOKEN_MAX_AGE = DIRECT_UPLOAD_EXPIRES + 600  # the POST must start in time; allow it 10 minutes to finish
+STATUS_POLL_MAX_DELAY = 8  # seconds; cap for the backoff suggested to the status page
+# Bump LLM_CACHE_VERSION whenever the Bedrock model or prompts change
+LLM_CACHE_VERSION = 'v4'
+LLM_CACHE_TTL = datetime.timedelta(days=7)
+
+# Large user uploads go to S3 as parallel 5MB parts
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=5 * 1024 * 1024,
+    multipart_chunksize=5 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
+
+# Small shared pool for overlapping independent network calls within a request
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='io')
+
+# Result CSVs larger than one part are streamed to S3 as a multipart upload
+CSV_PART_SIZE = 8 * 1024 * 1024  # S3 requires >= 5MB for every part but the last
+CSV_ROWS_PER_BATCH = 1000
+CSV_GZIP_LEVEL = 6  # OCR text compresses several-fold; level 6 keeps CPU time modest
+
+@lru_cache(maxsize=4)
+def _fetch_google_provider_cfg(discovery_url, epoch_hour):
+    """Fetch the Google OIDC discovery document (cached per URL for the given hour)"""
+    response = HTTP_SESSION.get(discovery_url, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    cfg = response.json()
+    return cfg["authorization_endpoint"], cfg["token_endpoint"], cfg["userinfo_endpoint"]
+
+def get_google_provider_cfg(discovery_url):
+    """Return (authorization_endpoint, token_endpoint, userinfo_endpoint) with a rolling 1-hour TTL"""
+    return _fetch_google_provider_cfg(discovery_url, int(time.time() // 3600))
+
+# Textract completion notifications arrive through SNS when a topic is configured; the status
+# poll then reads the recorded status and only asks Textract itself every few polls as a fallback
+SNS_FALLBACK_POLL_EVERY = 4
+# The status page only understands these; Textract's ERROR/PARTIAL_SUCCESS are reported as FAILED
+JOB_STATUSES = ('IN_PROGRESS', 'SUCCEEDED', 'FAILED')
+SNS_CERT_HOST = re.compile(r'^sns\.[a-z]{2}(-gov)?-[a-z]+-\d\.amazonaws\.com$')
+SNS_SIGNED_KEYS = {
+    'Notification': ('Message', 'MessageId', 'Subject', 'Timestamp', 'TopicArn', 'Type'),
+    'SubscriptionConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+    'UnsubscribeConfirmation': ('Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'),
+}
+
+@lru_cache(maxsize=8)
+def _fetch_sns_certificate(cert_url):
+    """Download and parse an SNS signing certificate (certificates are immutable per URL)"""
+    from cryptography import x509
+    response = HTTP_SESSION.get(cert_url, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return x509.load_pem_x509_certificate(response.content)
+
+def verify_sns_message(message):
+    """Return True if an SNS message carries a valid AWS signature"""
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    
+    keys = SNS_SIGNED_KEYS.get(message.get('Type'))
+    cert_url = message.get('SigningCertURL', '')
+    parsed = urlparse(cert_url)
+    # Only trust certificates served by SNS itself
+    if not keys or parsed.scheme != 'https' or not SNS_CERT_HOST.match(parsed.hostname or '') \
+            or not parsed.path.endswith('.pem'):
+        return False
+    
+    string_to_sign = ''.join(f"{key}\n{message[key]}\n" for key in keys if key in message)
+    algorithm = hashes.SHA256() if message.get('SignatureVersion') == '2' else hashes.SHA1()
+    try:
+        _fetch_sns_certificate(cert_url).public_key().verify(
+            base64.b64decode(message['Signature']), string_to_sign.encode('utf-8'),
+            padding.PKCS1v15(), algorithm)
+    except (InvalidSignature, KeyError, ValueError):
+        return False
+    return True
+
+# Per-tier usage limits (read-only, shared by every request)
+PLAN_LIMITS = types.MappingProxyType({
+    'free': types.MappingProxyType({
+        'documents': 5, 
+        'pages': 3, 
+        'filesize': 2 * 1024 * 1024,  # 2MB
+        'llm_analyses': 2
+    }),
+    'pro': types.MappingProxyType({
+        'documents': 200, 
+        'pages': 50, 
+        'filesize': 5 * 1024 * 1024,  # 5MB
+        'llm_analyses': 50
+    }),
+    'enterprise': types.MappingProxyType({
+        'documents': 1000,
+        'pages': 100,
+        'filesize': 50 * 1024 * 1024,  # 50MB
+        'llm_analyses': 500
+    })
+})
+
+HISTORY_PAGE_SIZE = 50  # documents per history page
+
+# Allowance for multipart boundaries and form fields on top of the file itself
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
 # --- 2. Define the Database Models (globally) ---
+# Timestamps are filled in by Postgres as naive UTC, matching datetime.utcnow() comparisons.
+# The Python defaults stay alongside for tables created before migrate_database.py set the server defaults
+UTC_NOW = db.text("(now() at time zone 'utc')")
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
-    google_id = db.Column(db.String(100), unique=True, nullable=False)
+    google_id = db.Column(db.String(100), unique=True, index=True, nullable=False)
     name = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(100), unique=True, nullable=False)
+    email = db.Column(db.String(100), unique=True, index=True, nullable=False)
     tier = db.Column(db.String(20), nullable=False, default='free')
-    usage_reset_date = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    usage_reset_date = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, server_default=UTC_NOW)
     documents_processed_this_month = db.Column(db.Integer, nullable=False, default=0)
     llm_analyses_this_month = db.Column(db.Integer, nullable=False, default=0)
     api_key = db.Column(db.String(64), nullable=True, unique=True)
     api_key_created = db.Column(db.DateTime, nullable=True)
+    stripe_customer_id = db.Column(db.String(255), nullable=True, unique=True, index=True)
 
     def get_id(self):
         return self.id
@@ -46,7 +186,7 @@ class DocumentHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
-    upload_date = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    upload_date = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, server_default=UTC_NOW)
     analysis_type = db.Column(db.String(50), nullable=True)
     textract_job_id = db.Column(db.String(100), nullable=False)
     csv_filename = db.Column(db.String(255), nullable=False)
@@ -56,6 +196,91 @@ class DocumentHistory(db.Model):
     processing_cost = db.Column(db.Float, nullable=True)
     
     user = db.relationship('User', backref='documents')
+    
+    # Serves the history page: one user's rows, newest first
+    __table_args__ = (db.Index('ix_document_history_user_upload', 'user_id', upload_date.desc()),)
+
+class ProcessedWebhook(db.Model):
+    __tablename__ = 'processed_webhooks'
+    event_id = db.Column(db.String(255), primary_key=True)
+    received_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, server_default=UTC_NOW)
+
+class LLMResult(db.Model):
+    __tablename__ = 'llm_results'
+    cache_key = db.Column(db.String(64), primary_key=True)
+    analysis = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=UTC_NOW)
+
+class TextractJob(db.Model):
+    __tablename__ = 'textract_jobs'
+    job_id = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(20), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=UTC_NOW)
+
+def hash_api_key(api_key):
+    """Digest stored in users.api_key; API requests are matched by hashing the presented key"""
+    return hashlib.blake2b(api_key.encode('utf-8'), digest_size=32).hexdigest()
+
+def llm_cache_key(user_id, analysis_type, text):
+    """Hash identifying one user's analysis of a given document text"""
+    prefix = f"{LLM_CACHE_VERSION}|{user_id}|{analysis_type}|"
+    return hashlib.sha256((prefix + text).encode('utf-8')).hexdigest()
+
+# Prebuilt lookup statements; SQLAlchemy caches their compiled SQL across requests
+USER_BY_EMAIL = select(User).where(User.email == bindparam('email'))
+USER_BY_STRIPE_CUSTOMER = select(User).where(User.stripe_customer_id == bindparam('customer_id'))
+
+# Recently handled Stripe event ids, so replays on a warm instance skip the database
+_SEEN_WEBHOOK_EVENTS = OrderedDict()
+_SEEN_WEBHOOK_EVENTS_MAX = 1024
+_seen_webhook_events_lock = threading.Lock()
+
+def webhook_event_seen(event_id):
+    """Return True if this process has already handled the Stripe event"""
+    with _seen_webhook_events_lock:
+        return event_id in _SEEN_WEBHOOK_EVENTS
+
+def remember_webhook_event(event_id):
+    """Record a handled Stripe event id, evicting the oldest beyond the cap"""
+    with _seen_webhook_events_lock:
+        _SEEN_WEBHOOK_EVENTS[event_id] = True
+        _SEEN_WEBHOOK_EVENTS.move_to_end(event_id)
+        if len(_SEEN_WEBHOOK_EVENTS) > _SEEN_WEBHOOK_EVENTS_MAX:
+            _SEEN_WEBHOOK_EVENTS.popitem(last=False)
+
+# Presigned download links per (user id, S3 key); reused until shortly before they expire
+DOWNLOAD_URL_EXPIRES = 300  # seconds
+DOWNLOAD_URL_REUSE_FOR = 240  # seconds, leaves a minute of validity on a reused link
+_DOWNLOAD_URLS = OrderedDict()
+_DOWNLOAD_URLS_MAX = 1024
+_download_urls_lock = threading.Lock()
+
+def cached_download_url(user_id, key):
+    """Return a previously signed download URL that is still fresh, or None"""
+    with _download_urls_lock:
+        entry = _DOWNLOAD_URLS.get((user_id, key))
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+def remember_download_url(user_id, key, url):
+    """Store a freshly signed download URL, evicting the oldest beyond the cap"""
+    with _download_urls_lock:
+        _DOWNLOAD_URLS[(user_id, key)] = (url, time.monotonic() + DOWNLOAD_URL_REUSE_FOR)
+        _DOWNLOAD_URLS.move_to_end((user_id, key))
+        if len(_DOWNLOAD_URLS) > _DOWNLOAD_URLS_MAX:
+            _DOWNLOAD_URLS.popitem(last=False)
+
+def _validate_stripe_config(secret_key, webhook_secret, price_id, log):
+    """Log a single line describing the Stripe configuration at startup"""
+    if not (secret_key and price_id):
+        log.info("Stripe not fully configured. Payment features disabled.")
+    elif not webhook_secret:
+        log.warning("Stripe webhook secret not configured; subscription changes will not be applied.")
+    elif secret_key.startswith('sk_live_'):
+        log.info("Production: Using live Stripe keys")
+    else:
+        log.info("Development: Using test Stripe keys")
 
 # --- 3. The Application Factory Function ---
 def create_app():
@@ -63,66 +288,84 @@ def create_app():
     load_dotenv(dotenv_path=dotenv_path)
 
     app = Flask(__name__, template_folder='../templates')
+    log = app.logger
+    log.setLevel(logging.INFO if os.environ.get('FLASK_ENV') == 'production' else logging.DEBUG)
 
     # --- CONFIGURATIONS ---
     app.secret_key = os.environ.get('SECRET_KEY')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     # Add connection pool settings for better reliability
+    # Hard cap on request bodies (largest plan file size plus room for the multipart form);
+    # Werkzeug rejects anything bigger before the upload is read
+    app.config['MAX_CONTENT_LENGTH'] = max(limits['filesize'] for limits in PLAN_LIMITS.values()) + UPLOAD_FORM_OVERHEAD
+    app.config['SQLALCHEMY_RECORD_QUERIES'] = False
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,        # Keep warm connections for concurrent requests
+        'max_overflow': 20,     # Allow short bursts above pool_size
+        'pool_use_lifo': True,  # Reuse the most recent connection so idle ones can expire
         'pool_pre_ping': True,  # Verify connections before use
         'pool_recycle': 300,    # Recycle connections every 5 minutes
         'connect_args': {
             'connect_timeout': 10,
-            'sslmode': 'require'
+            'sslmode': 'require',
+            # TCP keep-alives stop NATs/load balancers from silently dropping pooled connections
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10
         }
     }
     # Stripe configuration
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+    STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
     STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
     STRIPE_PRICE_ID = os.environ.get('STRIPE_PRICE_ID')
     STRIPE_PRO_PRICE_ID = os.environ.get('STRIPE_SUBSCRIPTION_PRICE_ID')
     STRIPE_ENTERPRISE_PRICE_ID = os.environ.get('STRIPE_ENTERPRISE_PRICE_ID')
     
-    # Validate Stripe configuration
-    stripe_enabled = bool(stripe.api_key and STRIPE_PRICE_ID)
-    if not stripe_enabled:
-        print("Info: Stripe not fully configured. Payment features disabled.")
-    elif stripe.api_key and stripe.api_key.startswith('sk_live_'):
-        print("✅ Production: Using live Stripe keys")
-        # Additional production validation
-        if not STRIPE_WEBHOOK_SECRET:
-            print("⚠️  Warning: Live webhook secret not configured!")
-    else:
-        print("🧪 Development: Using test Stripe keys")
-    
-    # Validate Stripe configuration
-    if not all([stripe.api_key, STRIPE_WEBHOOK_SECRET, STRIPE_PRICE_ID]):
-        print("Warning: Stripe configuration incomplete. Payment features may not work.")
-    
-    # Check if using test vs live keys
-    if stripe.api_key and stripe.api_key.startswith('sk_live_'):
-        print("Warning: Using live Stripe keys. Make sure this is intentional for production.")
-    PLAN_LIMITS = {
-        'free': {
-            'documents': 5, 
-            'pages': 3, 
-            'filesize': 2 * 1024 * 1024,  # 2MB
-            'llm_analyses': 2
-        },
-        'pro': {
-            'documents': 200, 
-            'pages': 50, 
-            'filesize': 5 * 1024 * 1024,  # 5MB
-            'llm_analyses': 50
-        },
-        'enterprise': {
-            'documents': 1000,
-            'pages': 100,
-            'filesize': 50 * 1024 * 1024,  # 50MB
-            'llm_analyses': 500
-        }
-    }
+    _validate_stripe_config(STRIPE_SECRET_KEY, STRIPE_WEBHOOK_SECRET, STRIPE_PRICE_ID, log)
+
+    # Signs the per-job tokens polled by /api/check_status
+    job_token_serializer = URLSafeTimedSerializer(app.secret_key, salt='job-status')
+    # Signs the S3 keys handed out by /presign for direct browser uploads
+    upload_token_serializer = URLSafeTimedSerializer(app.secret_key, salt='direct-upload')
+
+    # --- ENVIRONMENT (read once at startup, closed over by the routes) ---
+    AWS_REGION = os.environ.get('AWS_REGION')
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
+    GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
+    GOOGLE_DISCOVERY_URL = os.environ.get('GOOGLE_DISCOVERY_URL')
+    ADMIN_EMAIL = os.environ.get('ADMIN_EMAIL')
+    IS_PRODUCTION = os.environ.get('FLASK_ENV') == 'production'
+    DB_CREATE_ON_STARTUP = os.environ.get('DB_CREATE_ON_STARTUP', '1') != '0'
+    STRIPE_MODE = os.environ.get('STRIPE_MODE', 'subscription')
+    STRIPE_ONETIME_PRICE_ID = os.environ.get('STRIPE_ONETIME_PRICE_ID', STRIPE_PRICE_ID)
+    TEXTRACT_SNS_TOPIC_ARN = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+    TEXTRACT_SNS_ROLE_ARN = os.environ.get('TEXTRACT_SNS_ROLE_ARN')
+    # Textract publishes job completion to SNS only when both are configured
+    TEXTRACT_START_ARGS = {}
+    if TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_SNS_ROLE_ARN:
+        TEXTRACT_START_ARGS['NotificationChannel'] = {'SNSTopicArn': TEXTRACT_SNS_TOPIC_ARN, 'RoleArn': TEXTRACT_SNS_ROLE_ARN}
+
+    # --- AWS CLIENTS (built once, shared by all requests; botocore clients are thread-safe) ---
+    # One boto3 session resolves credentials and loads endpoint data once for every client
+    AWS_SESSION = boto3.session.Session(region_name=AWS_REGION)
+    # Status polls and result downloads hit these clients concurrently: keep enough pooled,
+    # kept-alive sockets that requests don't queue for (or re-handshake) a connection,
+    # and let adaptive retries back off on Textract/S3 throttling
+    AWS_CLIENT_CONFIG = Config(
+        max_pool_connections=50,
+        tcp_keepalive=True,
+        retries={'max_attempts': 3, 'mode': 'adaptive'}
+    )
+    TEXTRACT = AWS_SESSION.client('textract', config=AWS_CLIENT_CONFIG)
+    S3 = AWS_SESSION.client('s3', config=AWS_CLIENT_CONFIG.merge(Config(
+        signature_version='s3v4',
+        s3={'addressing_style': 'path'}
+    )))
+    # Imported with the app rather than on the first LLM-enabled request; the Bedrock
+    # client itself is still only built when an analysis is first requested
+    from api.llm_service import LLMAnalyzer
 
     # --- INITIALIZE EXTENSIONS WITH THE APP ---
     db.init_app(app)
@@ -130,48 +373,113 @@ def create_app():
     login_manager.login_view = 'login_page'
     
     # Create tables if they don't exist (for Vercel)
-    # This will create new tables (document_history) and add new columns to existing tables
-    with app.app_context():
-        try:
-            db.create_all()
-            print("Database tables created/verified")
-        except Exception as e:
-            print(f"Database initialization error: {e}")
+    # This will create new tables (document_history) and add new columns to existing tables.
+    # Deployments that run init-db / migrate_database.py themselves can set
+    # DB_CREATE_ON_STARTUP=0 to skip the schema checks on every cold start.
+    if DB_CREATE_ON_STARTUP:
+        with app.app_context():
+            try:
+                db.create_all()
+                print("Database tables created/verified")
+            except Exception as e:
+                print(f"Database initialization error: {e}")
 
     # --- HELPER FUNCTIONS (Needed for routes) ---
-    def get_all_textract_blocks(job_id, initial_response):
-        textract = boto3.client('textract', region_name=os.environ.get('AWS_REGION'))
-        blocks = initial_response['Blocks']
-        next_token = initial_response.get('NextToken')
-        while next_token:
-            response = textract.get_document_text_detection(JobId=job_id, NextToken=next_token)
-            blocks.extend(response['Blocks'])
-            next_token = response.get('NextToken')
-        return blocks
-
-    def create_and_upload_csv(blocks, original_filename):
-        s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION'), config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}))
-        string_buffer = io.StringIO()
-        writer = csv.writer(string_buffer)
-        writer.writerow(['DetectedText'])
-        for block in blocks:
-            if block['BlockType'] == 'LINE':
-                writer.writerow([block['Text']])
-        csv_string = string_buffer.getvalue()
-        csv_bytes = csv_string.encode('utf-8')
-        bytes_buffer = io.BytesIO(csv_bytes)
+    def get_stripe():
+        """Import and configure the Stripe SDK on first use, keeping it off the cold-start path"""
+        import stripe
+        stripe.api_key = STRIPE_SECRET_KEY
+        return stripe
+
+    def iter_line_texts(job_id, initial_response):
+        """Yield the text of each LINE block, fetching further Textract pages as they are needed"""
+        # botocore has no paginator for get_document_text_detection, so follow NextToken
+        # by hand and request the maximum page size to keep round-trips down
+        response = initial_response
+        next_page = None
+        try:
+            while True:
+                # Start fetching the next page before consuming this one so the
+                # Textract round-trip overlaps with CSV writing
+                next_token = response.get('NextToken')
+                next_page = IO_EXECUTOR.submit(TEXTRACT.get_document_text_detection,
+                    JobId=job_id, NextToken=next_token, MaxResults=TEXTRACT_PAGE_SIZE) if next_token else None
+                for block in response['Blocks']:
+                    if block['BlockType'] == 'LINE':
+                        yield block['Text']
+                if next_page is None:
+                    return
+                response = next_page.result()
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    def create_and_upload_csv(line_texts, original_filename):
         base_filename = os.path.splitext(original_filename)[0]
         csv_filename = f"{base_filename}_result.csv"
-        s3.upload_fileobj(bytes_buffer, os.environ.get('S3_BUCKET'), csv_filename, ExtraArgs={'ContentType': 'text/csv'})
+        
+        # Encode and gzip straight into a bytes buffer. Small CSVs (the common case) go up in a
+        # single PUT; larger ones are streamed as multipart parts so only one part is
+        # ever held in memory. S3 serves the object with Content-Encoding: gzip, which
+        # browsers decode transparently for downloads and the preview fetch
+        bytes_buffer = io.BytesIO()
+        gzip_buffer = gzip.GzipFile(fileobj=bytes_buffer, mode='wb', compresslevel=CSV_GZIP_LEVEL, mtime=0)
+        text_buffer = io.TextIOWrapper(gzip_buffer, encoding='utf-8', newline='', write_through=True)
+        writer = csv.writer(text_buffer)
+        writer.writerow(['DetectedText'])
+        rows = ([text] for text in line_texts)
+        upload_id = None
+        parts = []
+        
+        def flush_part():
+            nonlocal upload_id
+            if upload_id is None:
+                upload_id = S3.create_multipart_upload(Bucket=S3_BUCKET, Key=csv_filename,
+                    ContentType='text/csv', ContentEncoding='gzip')['UploadId']
+            part_number = len(parts) + 1
+            part = S3.upload_part(Bucket=S3_BUCKET, Key=csv_filename, UploadId=upload_id,
+                PartNumber=part_number, Body=bytes_buffer.getvalue())
+            parts.append({'ETag': part['ETag'], 'PartNumber': part_number})
+            bytes_buffer.seek(0)
+            bytes_buffer.truncate()
+        
+        try:
+            for batch in iter(lambda: list(itertools.islice(rows, CSV_ROWS_PER_BATCH)), []):
+                writer.writerows(batch)
+                if bytes_buffer.tell() >= CSV_PART_SIZE:
+                    flush_part()
+            # Write out the remaining compressed data and the gzip trailer
+            gzip_buffer.close()
+            
+            if upload_id is None:
+                S3.put_object(Bucket=S3_BUCKET, Key=csv_filename, Body=bytes_buffer.getvalue(),
+                    ContentType='text/csv', ContentEncoding='gzip')
+            else:
+                if bytes_buffer.tell():
+                    flush_part()
+                S3.complete_multipart_upload(Bucket=S3_BUCKET, Key=csv_filename, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+        except Exception:
+            if upload_id is not None:
+                S3.abort_multipart_upload(Bucket=S3_BUCKET, Key=csv_filename, UploadId=upload_id)
+            raise
+        finally:
+            gzip_buffer.close()
         return csv_filename
 
+    @lru_cache(maxsize=1)
+    def get_llm_analyzer():
+        """Build the Bedrock analyzer on first use and reuse its client for later requests"""
+        return LLMAnalyzer(AWS_REGION, session=AWS_SESSION)
+
     def check_llm_quota(user):
         """Check if user has remaining LLM analysis quota"""
         # Reset monthly counter if month has passed
-        if user.usage_reset_date < datetime.datetime.utcnow() - datetime.timedelta(days=30):
+        now = datetime.datetime.utcnow()
+        if user.usage_reset_date < now - datetime.timedelta(days=30):
             user.llm_analyses_this_month = 0
-            user.usage_reset_date = datetime.datetime.utcnow()
-            db.session.commit()
+            user.usage_reset_date = now
+            # Committed together with the rest of the caller's unit of work
         
         # Check user tier and monthly usage
         limit = PLAN_LIMITS.get(user.tier, {}).get('llm_analyses', 0)
@@ -179,8 +487,6 @@ def create_app():
 
     def upload_json_to_s3(analysis_result, original_filename):
         """Upload LLM analysis JSON to S3"""
-        s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION'), config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}))
-        
         # Generate filename from original document name
         base_filename = os.path.splitext(original_filename)[0]
         json_filename = f"{base_filename}_analysis.json"
@@ -190,14 +496,31 @@ def create_app():
         bytes_buffer = io.BytesIO(json_bytes)
         
         # Upload to S3 with proper content type
-        s3.upload_fileobj(bytes_buffer, os.environ.get('S3_BUCKET'), json_filename,
+        S3.upload_fileobj(bytes_buffer, S3_BUCKET, json_filename,
             ExtraArgs={'ContentType': 'application/json'})
         
         # Return S3 key for storage
         return json_filename
 
+    def generate_download_url(key):
+        """Return a short-lived presigned GET URL for an S3 object, or None on failure"""
+        url = cached_download_url(current_user.id, key)
+        if url:
+            return url
+        try:
+            url = S3.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': S3_BUCKET, 'Key': key},
+                ExpiresIn=DOWNLOAD_URL_EXPIRES
+            )
+        except Exception as e:
+            print(f"Error generating presigned URL for {key}: {e}")
+            return None
+        remember_download_url(current_user.id, key, url)
+        return url
+
     def save_to_history(user_id, filename, textract_job_id, csv_filename, json_filename, analysis_type, file_size=0, page_count=None):
-        """Save document processing record to history"""
+        """Add a document processing record to history; the caller commits"""
         # Create DocumentHistory record
         doc = DocumentHistory(
             user_id=user_id,
@@ -209,14 +532,14 @@ def create_app():
             file_size=file_size,
             page_count=page_count
         )
-        # Commit to database
         db.session.add(doc)
-        db.session.commit()
 
     # --- DEFINE ALL ROUTES AND LOGIC WITHIN THE FACTORY ---
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        # raiseload('*'): relationship access on current_user (e.g. .documents) must be
+        # loaded explicitly by the caller instead of silently lazy-loading per request
+        return db.session.get(User, int(user_id), options=[raiseload('*')])
     
     @app.cli.command("init-db")
     def init_db_command():
@@ -231,110 +554,101 @@ def create_app():
 
     @app.route("/login")
     def login():
-        discovery_url = os.environ.get('GOOGLE_DISCOVERY_URL')
-        print(f"Discovery URL: '{discovery_url}'")  # Debug logging
-        google_provider_cfg = requests.get(discovery_url).json()
-        authorization_endpoint = google_provider_cfg["authorization_endpoint"]
+        log.debug("Discovery URL: '%s'", GOOGLE_DISCOVERY_URL)
+        authorization_endpoint, _, _ = get_google_provider_cfg(GOOGLE_DISCOVERY_URL)
         # Use HTTP for local development, HTTPS for production/Vercel
         is_vercel = 'vercel.app' in request.host
-        scheme = 'https' if (request.is_secure or os.environ.get('FLASK_ENV') == 'production' or is_vercel) else 'http'
-        request_uri = requests.Request("GET", authorization_endpoint, params={"client_id": os.environ.get('GOOGLE_CLIENT_ID'), "redirect_uri": url_for('callback', _external=True, _scheme=scheme), "response_type": "code", "scope": "openid email profile"}).prepare().url
+        scheme = 'https' if (request.is_secure or IS_PRODUCTION or is_vercel) else 'http'
+        request_uri = f"{authorization_endpoint}?" + urlencode({"client_id": GOOGLE_CLIENT_ID, "redirect_uri": url_for('callback', _external=True, _scheme=scheme), "response_type": "code", "scope": "openid email profile"})
         return redirect(request_uri)
 
     @app.route("/login/callback")
     def callback():
         try:
-            print("=== OAuth Callback Started ===")
+            log.debug("=== OAuth Callback Started ===")
             code = request.args.get("code")
-            print(f"Authorization code received: {code[:10]}..." if code else "No code received")
+            log.debug("Authorization code received: %s", "yes" if code else "no")
             
             if not code:
                 return "No authorization code received from Google", 400
             
-            discovery_url = os.environ.get('GOOGLE_DISCOVERY_URL')
-            print(f"Discovery URL: '{discovery_url}'")
-            
-            google_provider_cfg = requests.get(discovery_url).json()
-            token_endpoint = google_provider_cfg["token_endpoint"]
-            print(f"Token endpoint: {token_endpoint}")
+            log.debug("Discovery URL: '%s'", GOOGLE_DISCOVERY_URL)
+            _, token_endpoint, userinfo_endpoint = get_google_provider_cfg(GOOGLE_DISCOVERY_URL)
+            log.debug("Token endpoint: %s", token_endpoint)
             
             # Use HTTP for local development, HTTPS for production/Vercel
             is_vercel = 'vercel.app' in request.host
-            scheme = 'https' if (request.is_secure or os.environ.get('FLASK_ENV') == 'production' or is_vercel) else 'http'
-            print(f"Using scheme: {scheme}, Host: {request.host}")
+            scheme = 'https' if (request.is_secure or IS_PRODUCTION or is_vercel) else 'http'
+            log.debug("Using scheme: %s, Host: %s", scheme, request.host)
             
             redirect_uri = url_for('callback', _external=True, _scheme=scheme)
-            print(f"Redirect URI: {redirect_uri}")
+            log.debug("Redirect URI: %s", redirect_uri)
             
-            token_response = requests.post(token_endpoint, data={
-                "client_id": os.environ.get('GOOGLE_CLIENT_ID'),
-                "client_secret": os.environ.get('GOOGLE_CLIENT_SECRET'),
+            token_response = HTTP_SESSION.post(token_endpoint, data={
+                "client_id": GOOGLE_CLIENT_ID,
+                "client_secret": GOOGLE_CLIENT_SECRET,
                 "grant_type": "authorization_code",
                 "code": code,
                 "redirect_uri": redirect_uri
-            }).json()
+            }, timeout=HTTP_TIMEOUT).json()
             
-            print(f"Token response keys: {list(token_response.keys())}")
+            log.debug("Token response keys: %s", list(token_response))
             
             # Check for token response errors
             if 'error' in token_response:
-                print(f"Token error: {token_response}")
+                log.warning("Token error: %s", token_response.get('error'))
                 return f"OAuth error: {token_response.get('error_description', 'Unknown error')}", 400
                 
             if 'access_token' not in token_response:
-                print(f"No access token in response: {token_response}")
+                log.warning("No access token in response (keys: %s)", list(token_response))
                 return "Failed to get access token from Google", 400
                 
-            userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-            userinfo_response = requests.get(userinfo_endpoint, headers={"Authorization": f"Bearer {token_response['access_token']}"}).json()
+            userinfo_response = HTTP_SESSION.get(userinfo_endpoint, headers={"Authorization": f"Bearer {token_response['access_token']}"}, timeout=HTTP_TIMEOUT).json()
             
-            print(f"User info received: {userinfo_response.get('email', 'No email')}")
+            log.debug("User info received: %s", userinfo_response.get('email', 'No email'))
             
             if userinfo_response.get("email_verified"):
                 unique_id = userinfo_response["sub"]
                 users_email = userinfo_response["email"]
                 users_name = userinfo_response.get("given_name", userinfo_response.get("name", "User"))
                 
-                print(f"Creating/finding user: {users_email}")
+                log.debug("Creating/finding user: %s", users_email)
                 
                 # Database operations with retry logic for connection issues
                 max_retries = 3
                 for attempt in range(max_retries):
                     try:
-                        user = User.query.filter_by(google_id=unique_id).first()
-                        if not user:
-                            print("Creating new user")
-                            user = User(google_id=unique_id, name=users_name, email=users_email)
-                            db.session.add(user)
-                            db.session.commit()
-                        else:
-                            print("User found, logging in")
+                        # Single INSERT ... ON CONFLICT so parallel callbacks can't race on google_id
+                        stmt = pg_insert(User).values(google_id=unique_id, name=users_name, email=users_email)
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=[User.google_id],
+                            set_={'name': stmt.excluded.name}
+                        ).returning(User)
+                        user = db.session.execute(stmt).scalar_one()
+                        db.session.commit()
                         
                         login_user(user)
-                        print("User logged in successfully, redirecting to index")
+                        log.debug("User logged in successfully, redirecting to index")
                         return redirect(url_for("index"))
                         
                     except Exception as db_error:
-                        print(f"Database attempt {attempt + 1} failed: {db_error}")
+                        log.warning("Database attempt %d failed: %s", attempt + 1, db_error)
                         if attempt < max_retries - 1:
                             # Rollback and retry
                             db.session.rollback()
-                            import time
                             time.sleep(1)  # Wait 1 second before retry
                             continue
                         else:
                             # Final attempt failed
                             db.session.rollback()
-                            print(f"All database attempts failed for user {users_email}")
+                            log.error("All database attempts failed for user %s", users_email)
                             return "Database temporarily unavailable. Please try signing in again in a moment.", 503
                 
-            print("Email not verified by Google")
+            log.debug("Email not verified by Google")
             return "User email not available or not verified by Google.", 400
             
         except Exception as e:
-            print(f"Callback error: {str(e)}")
-            import traceback
-            print(f"Traceback: {traceback.format_exc()}")
+            log.exception("Callback error: %s", e)
             return f"Internal error: {str(e)}", 500
 
     @app.route("/logout")
@@ -347,13 +661,21 @@ def create_app():
     def check_usage_limit(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if current_user.tier != 'pro' and current_user.usage_reset_date < datetime.datetime.utcnow() - datetime.timedelta(days=30):
-                current_user.documents_processed_this_month = 0
-                current_user.usage_reset_date = datetime.datetime.utcnow()
-                db.session.commit()
-            limit = PLAN_LIMITS[current_user.tier]['documents']
+            tier = current_user.tier
+            if tier != 'pro':
+                now = datetime.datetime.utcnow()
+                cutoff = now - datetime.timedelta(days=30)
+                if current_user.usage_reset_date < cutoff:
+                    # Conditional UPDATE so concurrent uploads can't both reset the counter;
+                    # it is committed together with the route's own usage increment
+                    db.session.execute(
+                        update(User)
+                        .where(User.id == current_user.id, User.usage_reset_date < cutoff)
+                        .values(documents_processed_this_month=0, usage_reset_date=now)
+                    )
+            limit = PLAN_LIMITS[tier]['documents']
             if current_user.documents_processed_this_month >= limit:
-                if current_user.tier == 'free':
+                if tier == 'free':
                     flash(f"You've reached your monthly limit of {limit} documents. Upgrade to Pro for 200 documents/month!", "upgrade")
                 else:
                     flash(f"You've reached your monthly limit of {limit} documents. Your limit will reset next month.", "warning")
@@ -361,6 +683,11 @@ def create_app():
             return f(*args, **kwargs)
         return decorated_function
 
+    @app.errorhandler(413)
+    def request_entity_too_large(e):
+        max_mb = app.config['MAX_CONTENT_LENGTH'] // 1024 // 1024
+        return f"File size exceeds the {max_mb}MB limit.", 413
+
     # --- Core Application Routes ---
     @app.route('/favicon.ico')
     def favicon():
@@ -395,7 +722,7 @@ def create_app():
     @login_required
     def admin_stats():
         # Secure admin check using environment variable
-        admin_email = os.environ.get('ADMIN_EMAIL')
+        admin_email = ADMIN_EMAIL
         if not admin_email or current_user.email != admin_email:
             # Don't reveal that this endpoint exists
             return "Page not found", 404
@@ -405,18 +732,18 @@ def create_app():
             return "Page not found", 404
             
         try:
-            total_users = User.query.count()
-            pro_users = User.query.filter_by(tier='pro').count()
-            free_users = User.query.filter_by(tier='free').count()
-            
-            # Monthly usage stats
-            total_docs_this_month = db.session.query(db.func.sum(User.documents_processed_this_month)).scalar() or 0
+            # User counts and monthly usage per tier in one grouped query
+            rows = db.session.execute(
+                select(User.tier, db.func.count(User.id), db.func.coalesce(db.func.sum(User.documents_processed_this_month), 0))
+                .group_by(User.tier)
+            ).all()
+            users_by_tier = {tier: count for tier, count, _ in rows}
             
             stats = {
-                'total_users': total_users,
-                'pro_subscribers': pro_users,
-                'free_users': free_users,
-                'total_docs_processed': total_docs_this_month
+                'total_users': sum(users_by_tier.values()),
+                'pro_subscribers': users_by_tier.get('pro', 0),
+                'free_users': users_by_tier.get('free', 0),
+                'total_docs_processed': sum(docs for _, _, docs in rows)
             }
             
             return f"""
@@ -440,99 +767,225 @@ def create_app():
             print(f"Admin stats error: {e}")
             return "Service temporarily unavailable", 503
 
+    @app.route('/presign', methods=['POST'])
+    @login_required
+    def presign_upload():
+        """Issue a presigned POST so the browser can upload straight to S3"""
+        limits = PLAN_LIMITS[current_user.tier]
+        if current_user.documents_processed_this_month >= limits['documents']:
+            # Let the regular form post show the usual limit message
+            return jsonify({'error': 'Monthly document limit reached'}), 403
+        
+        data = request.get_json(silent=True) or {}
+        filename = data.get('filename')
+        content_type = data.get('content_type') or 'application/octet-stream'
+        if not filename:
+            return jsonify({'error': 'No file selected.'}), 400
+        size = data.get('size')
+        if isinstance(size, int) and size > limits['filesize']:
+            return jsonify({'error': f"File size exceeds the {limits['filesize'] // 1024 // 1024}MB limit."}), 413
+        
+        presigned = S3.generate_presigned_post(
+            Bucket=S3_BUCKET,
+            Key=filename,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, limits['filesize']]
+            ],
+            ExpiresIn=DIRECT_UPLOAD_EXPIRES
+        )
+        # /upload only trusts keys it handed out itself
+        upload_token = upload_token_serializer.dumps({'uid': current_user.id, 'key': filename,
+                                                      'size': size if isinstance(size, int) else 0})
+        return jsonify({'url': presigned['url'], 'fields': presigned['fields'], 'upload_token': upload_token})
+
     @app.route('/upload', methods=['POST'])
     @login_required
     @check_usage_limit
     def upload():
-        s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION'), config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}))
-        textract = boto3.client('textract', region_name=os.environ.get('AWS_REGION'))
-        if 'file' not in request.files: return "No file part.", 400
-        file = request.files['file']
-        if file.filename == '': return "No file selected.", 400
         filesize_limit = PLAN_LIMITS[current_user.tier]['filesize']
-        file.seek(0, os.SEEK_END)
-        file_length = file.tell()
-        if file_length > filesize_limit: return f"File size exceeds the {filesize_limit // 1024 // 1024}MB limit.", 413
-        file.seek(0)
+        content_length = request.content_length
+        # Reject clearly oversized uploads from the Content-Length header before the body is parsed
+        if content_length and content_length > filesize_limit + UPLOAD_FORM_OVERHEAD:
+            return f"File size exceeds the {filesize_limit // 1024 // 1024}MB limit.", 413
+        
+        # Files sent straight to S3 via /presign arrive as a signed token instead of bytes
+        upload_token = request.form.get('upload_token')
+        file = None
+        if upload_token:
+            try:
+                claims = upload_token_serializer.loads(upload_token, max_age=UPLOAD_TOKEN_MAX_AGE)
+            except BadSignature:
+                return "Upload link expired. Please try again.", 400
+            if claims['uid'] != current_user.id:
+                return "Upload link expired. Please try again.", 400
+            filename = claims['key']
+            file_size = claims.get('size', 0)
+        else:
+            if 'file' not in request.files: return "No file part.", 400
+            file = request.files['file']
+            if file.filename == '': return "No file selected.", 400
+            # The upload is already buffered locally, so its size costs a seek rather than a HEAD later.
+            # Measure it before upload_fileobj, which closes the stream it is given
+            file.seek(0, os.SEEK_END)
+            file_size = file.tell()
+            if file_size > filesize_limit: return f"File size exceeds the {filesize_limit // 1024 // 1024}MB limit.", 413
+            file.seek(0)
+            filename = file.filename
         
         # Accept LLM analysis parameters from form
         enable_llm = request.form.get('enable_llm') == 'true'
         analysis_type = request.form.get('analysis_type', 'general')
         
-        # Store LLM preferences in Flask session for later use
-        session['enable_llm'] = enable_llm
-        session['analysis_type'] = analysis_type if enable_llm else None
+        # LLM preferences travel with this job's URLs rather than the shared session
+        job_analysis_type = analysis_type if enable_llm else None
         
+        textract_job = None
         try:
-            s3.upload_fileobj(file, os.environ.get('S3_BUCKET'), file.filename, ExtraArgs={'ContentType': file.content_type})
-            response = textract.start_document_text_detection(DocumentLocation={'S3Object': {'Bucket': os.environ.get('S3_BUCKET'), 'Name': file.filename}})
-            current_user.documents_processed_this_month += 1
+            if file is not None:
+                S3.upload_fileobj(file, S3_BUCKET, filename, ExtraArgs={'ContentType': file.content_type}, Config=UPLOAD_TRANSFER_CONFIG)
+            # Submit the Textract job from a worker thread while this thread sends the usage
+            # increment to the database; the session itself never leaves this thread
+            textract_job = IO_EXECUTOR.submit(TEXTRACT.start_document_text_detection,
+                DocumentLocation={'S3Object': {'Bucket': S3_BUCKET, 'Name': filename}}, **TEXTRACT_START_ARGS)
+            # Atomic increment so concurrent uploads from the same user aren't lost
+            db.session.execute(
+                update(User)
+                .where(User.id == current_user.id)
+                .values(documents_processed_this_month=User.documents_processed_this_month + 1)
+            )
+            response = textract_job.result()
             db.session.commit()
-            return redirect(url_for('status', job_id=response['JobId'], original_filename=file.filename))
+            # The file size rides along on the job URLs for the history record written by process_result
+            return redirect(url_for('status', job_id=response['JobId'], original_filename=filename,
+                                    analysis_type=job_analysis_type, file_size=file_size))
         except Exception as e:
+            # Don't count the upload if the Textract job could not be started
+            db.session.rollback()
+            if textract_job is not None:
+                # The job may have started even though the usage update failed; log it so it isn't lost
+                try:
+                    log.error("Textract job %s for %s started but not recorded: %s",
+                              textract_job.result()['JobId'], filename, e)
+                except Exception:
+                    pass
             return f"An error occurred: {str(e)}", 500
 
     @app.route('/status/<job_id>/<original_filename>')
     @login_required
     def status(job_id, original_filename):
-        return render_template('status.html', job_id=job_id, original_filename=original_filename)
+        # Signed token lets the status poll skip the session/user lookup entirely
+        status_token = job_token_serializer.dumps({'uid': current_user.id, 'job': job_id})
+        result_url = url_for('process_result', job_id=job_id, original_filename=original_filename,
+                             analysis_type=request.args.get('analysis_type'),
+                             file_size=request.args.get('file_size', type=int))
+        return render_template('status.html', job_id=job_id, original_filename=original_filename,
+                               status_token=status_token, result_url=result_url)
 
-    @app.route('/api/check_status/<job_id>')
-    @login_required
-    def check_status(job_id):
-        textract = boto3.client('textract', region_name=os.environ.get('AWS_REGION'))
+    @app.route('/api/check_status/<token>')
+    def check_status(token):
         try:
-            response = textract.get_document_text_detection(JobId=job_id)
-            return jsonify({'status': response.get('JobStatus')})
+            job_id = job_token_serializer.loads(token, max_age=JOB_TOKEN_MAX_AGE)['job']
+        except BadSignature:
+            return jsonify({'status': 'FAILED', 'error': 'Invalid or expired status token'}), 403
+        # Suggest the next poll delay: 1s, 2s, 4s, then every 8s
+        attempt = request.args.get('attempt', 0, type=int)
+        retry_after = min(2 ** min(max(attempt, 0), 3), STATUS_POLL_MAX_DELAY)
+        try:
+            if TEXTRACT_START_ARGS:
+                # Completion is pushed through SNS; ask Textract only every few polls in case it was missed
+                job = db.session.get(TextractJob, job_id)
+                if job:
+                    return jsonify({'status': job.status, 'retry_after': retry_after}), 200, {'Retry-After': str(retry_after)}
+                if attempt % SNS_FALLBACK_POLL_EVERY != SNS_FALLBACK_POLL_EVERY - 1:
+                    return jsonify({'status': 'IN_PROGRESS', 'retry_after': retry_after}), 200, {'Retry-After': str(retry_after)}
+            # Only JobStatus is needed, so keep the response to a single block
+            response = TEXTRACT.get_document_text_detection(JobId=job_id, MaxResults=1)
+            job_status = response.get('JobStatus')
+            if job_status not in JOB_STATUSES:
+                job_status = 'FAILED'
+            return jsonify({'status': job_status, 'retry_after': retry_after}), 200, {'Retry-After': str(retry_after)}
         except Exception as e:
             return jsonify({'status': 'FAILED', 'error': str(e)})
 
+    @app.route('/sns/textract', methods=['POST'])
+    def textract_notification():
+        """Record Textract job completion pushed through the configured SNS topic"""
+        try:
+            message = json.loads(request.get_data(cache=False))
+        except ValueError:
+            return "Invalid message", 400
+        if message.get('TopicArn') != TEXTRACT_SNS_TOPIC_ARN or not verify_sns_message(message):
+            return "Invalid signature", 403
+        
+        if message['Type'] == 'SubscriptionConfirmation':
+            HTTP_SESSION.get(message['SubscribeURL'], timeout=HTTP_TIMEOUT).raise_for_status()
+            log.info("Confirmed SNS subscription for %s", TEXTRACT_SNS_TOPIC_ARN)
+        elif message['Type'] == 'Notification':
+            job = json.loads(message['Message'])
+            job_status = job['Status'] if job['Status'] in JOB_STATUSES else 'FAILED'
+            stmt = pg_insert(TextractJob).values(job_id=job['JobId'], status=job_status)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[TextractJob.job_id],
+                set_={'status': stmt.excluded.status, 'updated_at': UTC_NOW}
+            ))
+            db.session.commit()
+        return '', 204
+
     # --- THE MISSING ROUTES ARE NOW HERE ---
     @app.route('/process_result/<job_id>/<original_filename>')
     @login_required
     def process_result(job_id, original_filename):
-        textract = boto3.client('textract', region_name=os.environ.get('AWS_REGION'))
         try:
-            response = textract.get_document_text_detection(JobId=job_id)
+            response = TEXTRACT.get_document_text_detection(JobId=job_id, MaxResults=TEXTRACT_PAGE_SIZE)
             if response.get('JobStatus') == 'SUCCEEDED':
-                blocks = get_all_textract_blocks(job_id, response)
-                csv_filename = create_and_upload_csv(blocks, original_filename)
-                
-                # Check session for LLM enablement
+                # An analysis type on the URL means LLM analysis was requested for this job
                 json_filename = None
-                enable_llm = session.get('enable_llm', False)
-                analysis_type = session.get('analysis_type')
+                analysis_type = request.args.get('analysis_type')
+                enable_llm = bool(analysis_type)
+                
+                line_texts = iter_line_texts(job_id, response)
+                if enable_llm and analysis_type:
+                    # LLM analysis needs the text again after the CSV is written
+                    line_texts = list(line_texts)
+                csv_filename = create_and_upload_csv(line_texts, original_filename)
                 
                 # Call check_llm_quota before processing
                 if enable_llm and analysis_type:
                     if check_llm_quota(current_user):
                         try:
                             # Extract text from Textract blocks
-                            text = '\n'.join([block['Text'] for block in blocks if block['BlockType'] == 'LINE'])
+                            text = '\n'.join(line_texts)
                             
-                            # Invoke LLMAnalyzer if enabled and quota available
-                            from api.llm_service import LLMAnalyzer
-                            analyzer = LLMAnalyzer(os.environ.get('AWS_REGION'))
-                            analysis_result = analyzer.analyze_document(text, analysis_type)
+                            # Reuse a recent analysis of the same text instead of calling Bedrock again
+                            cache_key = llm_cache_key(current_user.id, analysis_type, text)
+                            cached = db.session.get(LLMResult, cache_key)
+                            now = datetime.datetime.utcnow()
+                            if cached and cached.created_at > now - LLM_CACHE_TTL:
+                                analysis_result = json.loads(cached.analysis)
+                            else:
+                                # Invoke LLMAnalyzer if enabled and quota available
+                                analysis_result = get_llm_analyzer().analyze_document(text, analysis_type)
+                                if 'error' not in analysis_result:
+                                    db.session.merge(LLMResult(cache_key=cache_key, analysis=json.dumps(analysis_result), created_at=now))
+                                
+                                # Atomic increment of the user's LLM usage counter
+                                db.session.execute(
+                                    update(User)
+                                    .where(User.id == current_user.id)
+                                    .values(llm_analyses_this_month=User.llm_analyses_this_month + 1)
+                                )
                             
                             # Upload JSON results to S3
                             json_filename = upload_json_to_s3(analysis_result, original_filename)
-                            
-                            # Increment user's LLM usage counter
-                            current_user.llm_analyses_this_month += 1
-                            db.session.commit()
                         except Exception as llm_error:
                             # Log error but don't fail the entire request
                             print(f"LLM analysis error: {llm_error}")
                             # Continue without LLM analysis
                 
-                # Get file size from S3 for history
-                s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION'))
-                try:
-                    s3_response = s3.head_object(Bucket=os.environ.get('S3_BUCKET'), Key=original_filename)
-                    file_size = s3_response.get('ContentLength', 0)
-                except:
-                    file_size = 0
+                # File size passed along by /upload for history
+                file_size = request.args.get('file_size', 0, type=int)
                 
                 # Call save_to_history with all metadata
                 save_to_history(
@@ -545,54 +998,41 @@ def create_app():
                     file_size=file_size,
                     page_count=None  # Could extract from Textract response if needed
                 )
+                # One commit for the quota reset, LLM counter and history row
+                db.session.commit()
                 
                 # Pass json_filename to success route
-                return redirect(url_for('success', csv_filename=csv_filename, json_filename=json_filename))
+                return redirect(url_for('success', csv_filename=csv_filename, json_filename=json_filename,
+                                        analysis_type=analysis_type if json_filename else None))
             else:
                 return "Job did not succeed. Status: " + response.get('JobStatus'), 500
         except Exception as e:
+            db.session.rollback()
             return f"An error occurred during final processing: {str(e)}", 500
 
     @app.route('/success/<csv_filename>')
     @login_required
     def success(csv_filename):
-        s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION'), config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}))
-        
         # Accept optional json_filename parameter
         json_filename = request.args.get('json_filename')
         
-        # Generate presigned URL for CSV file
-        try:
-            download_url = s3.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': os.environ.get('S3_BUCKET'), 'Key': csv_filename},
-                ExpiresIn=300
-            )
-        except Exception as e:
-            print(f"Error generating presigned URL: {e}")
-            download_url = None
+        # Signed links are memoized per user and key, so reloading this page reuses them
+        download_url = generate_download_url(csv_filename)
         
         # Generate presigned URL for JSON file if present
         json_url = None
         analysis_type = None
         if json_filename:
-            try:
-                json_url = s3.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': os.environ.get('S3_BUCKET'), 'Key': json_filename},
-                    ExpiresIn=300
-                )
-                # Get analysis type from session
-                analysis_type = session.get('analysis_type')
-            except Exception as e:
-                print(f"Error generating JSON presigned URL: {e}")
+            json_url = generate_download_url(json_filename)
+            if json_url:
+                analysis_type = request.args.get('analysis_type')
         
         # Pass both URLs to template
         return render_template(
             'result.html',
             csv_filename=csv_filename,
             json_filename=json_filename,
-            bucket_name=os.environ.get('S3_BUCKET'),
+            bucket_name=S3_BUCKET,
             download_url=download_url,
             json_url=json_url,
             analysis_type=analysis_type
@@ -601,66 +1041,53 @@ def create_app():
     @app.route('/preview/<path:csv_filename>')
     @login_required
     def preview_csv(csv_filename):
-        """Serve CSV content for preview without CORS issues"""
-        from urllib.parse import unquote
-        
-        # Decode URL-encoded filename (may need multiple decodes)
-        decoded_filename = csv_filename
-        # Keep decoding until no more %XX patterns are found
-        while '%' in decoded_filename:
-            new_decoded = unquote(decoded_filename)
-            if new_decoded == decoded_filename:
-                break  # No more decoding needed
-            decoded_filename = new_decoded
-            
-        print(f"Original filename: {csv_filename}")
-        print(f"Decoded filename: {decoded_filename}")
-        
-        s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION'), config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}))
-        
-        # Try different filename variations
-        filenames_to_try = [
-            decoded_filename,
-            csv_filename,  # Original encoded version
-            unquote(csv_filename),  # Single decode
-        ]
-        
-        for filename in filenames_to_try:
-            try:
-                print(f"Trying filename: {filename}")
-                # Get the CSV content from S3
-                response = s3.get_object(Bucket=os.environ.get('S3_BUCKET'), Key=filename)
-                csv_content = response['Body'].read().decode('utf-8')
-                
-                # Extract just the text content (skip CSV header)
-                lines = csv_content.split('\n')
-                if len(lines) > 1:
-                    # Skip the header row and join the rest
-                    text_content = '\n'.join(line.strip('"') for line in lines[1:] if line.strip())
-                else:
-                    text_content = csv_content
-                    
-                return text_content, 200, {'Content-Type': 'text/plain; charset=utf-8'}
-            except Exception as e:
-                print(f"Failed with filename '{filename}': {e}")
-                continue
-        
-        # If all attempts failed, return error
-        return "Error: Could not load the file for preview. The file may have been moved or deleted.", 500
+        """Redirect to a short-lived S3 link for the CSV; the page strips the header itself"""
+        try:
+            url = S3.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': S3_BUCKET, 'Key': csv_filename, 'ResponseContentType': 'text/plain; charset=utf-8'},
+                ExpiresIn=DOWNLOAD_URL_EXPIRES
+            )
+        except Exception as e:
+            print(f"Failed to sign preview link for '{csv_filename}': {e}")
+            return "Error: Could not load the file for preview. The file may have been moved or deleted.", 500
+        return redirect(url, code=302)
 
     # --- Document History Routes ---
     @app.route('/history')
     @login_required
     def history():
         """Display user's document processing history"""
-        # Query DocumentHistory for current user
-        documents = DocumentHistory.query.filter_by(user_id=current_user.id)\
-            .order_by(DocumentHistory.upload_date.desc())\
-            .limit(50)\
+        # Query DocumentHistory for current user, loading only the columns the list renders
+        query = DocumentHistory.query.filter_by(user_id=current_user.id)
+        
+        # Keyset pagination: ?before=<upload date>&before_id=<id> of the last row shown continues
+        # the list from the (user_id, upload_date DESC) index instead of skipping rows with OFFSET;
+        # the id breaks ties so rows sharing a timestamp with the page boundary aren't skipped
+        before = request.args.get('before')
+        before_id = request.args.get('before_id', type=int)
+        if before:
+            try:
+                before_date = datetime.datetime.fromisoformat(before)
+            except ValueError:
+                return redirect(url_for('history'))
+            if before_id is None:
+                return redirect(url_for('history'))
+            query = query.filter(tuple_(DocumentHistory.upload_date, DocumentHistory.id) < tuple_(before_date, before_id))
+        
+        documents = query\
+            .options(load_only(DocumentHistory.id, DocumentHistory.filename, DocumentHistory.upload_date,
+                               DocumentHistory.analysis_type, DocumentHistory.json_filename))\
+            .order_by(DocumentHistory.upload_date.desc(), DocumentHistory.id.desc())\
+            .limit(HISTORY_PAGE_SIZE)\
             .all()
         
+        older_url = None
+        if len(documents) == HISTORY_PAGE_SIZE:
+            older_url = url_for('history', before=documents[-1].upload_date.isoformat(), before_id=documents[-1].id)
+        
         # Render history.html template
-        return render_template('history.html', documents=documents)
+        return render_template('history.html', documents=documents, older_url=older_url)
 
     @app.route('/history/<int:doc_id>')
     @login_required
@@ -670,17 +1097,11 @@ def create_app():
         doc = DocumentHistory.query.filter_by(id=doc_id, user_id=current_user.id).first_or_404()
         
         # Generate presigned URLs for CSV and JSON
-        s3 = boto3.client('s3', region_name=os.environ.get('AWS_REGION'), config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}))
-        
-        csv_url = s3.generate_presigned_url('get_object', 
-            Params={'Bucket': os.environ.get('S3_BUCKET'), 'Key': doc.csv_filename},
-            ExpiresIn=300)
+        csv_url = generate_download_url(doc.csv_filename)
         
         json_url = None
         if doc.json_filename:
-            json_url = s3.generate_presigned_url('get_object',
-                Params={'Bucket': os.environ.get('S3_BUCKET'), 'Key': doc.json_filename},
-                ExpiresIn=300)
+            json_url = generate_download_url(doc.json_filename)
         
         # Render result.html with from_history flag
         return render_template('result.html', 
@@ -704,8 +1125,8 @@ def create_app():
         import secrets
         api_key = 'cvocr_' + secrets.token_urlsafe(48)  # 64 character key with prefix
         
-        # Store in user.api_key field
-        current_user.api_key = api_key
+        # Store only a digest of the key; the raw key is shown once below
+        current_user.api_key = hash_api_key(api_key)
         current_user.api_key_created = datetime.datetime.utcnow()
         db.session.commit()
         
@@ -743,9 +1164,10 @@ def create_app():
     @app.route('/create-checkout-session/<payment_type>/<tier>')
     @login_required
     def create_checkout_session(payment_type=None, tier=None):
+        stripe = get_stripe()
         try:
             # Use HTTP for local development, HTTPS for production
-            scheme = 'https' if request.is_secure or os.environ.get('FLASK_ENV') == 'production' else 'http'
+            scheme = 'https' if request.is_secure or IS_PRODUCTION else 'http'
             
             # Generate URLs with proper scheme
             success_url = url_for('index', _external=True, _scheme=scheme)
@@ -753,7 +1175,7 @@ def create_app():
             
             # Determine payment type from URL parameter or environment variable
             if payment_type is None:
-                payment_type = 'subscription' if os.environ.get('STRIPE_MODE', 'subscription') == 'subscription' else 'onetime'
+                payment_type = 'subscription' if STRIPE_MODE == 'subscription' else 'onetime'
             
             is_subscription = payment_type == 'subscription'
             
@@ -771,7 +1193,7 @@ def create_app():
                     tier_metadata = 'enterprise'
                 else:
                     # Default to Pro tier
-                    price_id = STRIPE_PRO_PRICE_ID or os.environ.get('STRIPE_PRICE_ID')
+                    price_id = STRIPE_PRO_PRICE_ID or STRIPE_PRICE_ID
                     plan_name = 'Pro'
                     plan_price = '$10/month'
                     tier_metadata = 'pro'
@@ -802,7 +1224,7 @@ def create_app():
                 
             else:
                 # One-time payment mode
-                price_id = os.environ.get('STRIPE_ONETIME_PRICE_ID', os.environ.get('STRIPE_PRICE_ID'))
+                price_id = STRIPE_ONETIME_PRICE_ID
                 checkout_params = {
                     'line_items': [{'price': price_id, 'quantity': 1}],
                     'mode': 'payment',
@@ -834,9 +1256,11 @@ def create_app():
     def stripe_webhook():
         if not STRIPE_WEBHOOK_SECRET:
             return 'Webhook not configured', 400
+        stripe = get_stripe()
             
-        payload = request.data
-        sig_header = request.headers.get('STRIPE_SIGNATURE')
+        # Verify against the raw body exactly as Stripe signed it; no need to keep a cached copy
+        payload = request.get_data(cache=False)
+        sig_header = request.headers.get('Stripe-Signature')
         event = None
         
         try:
@@ -845,11 +1269,19 @@ def create_app():
             print(f"Webhook signature verification failed: {e}")
             return 'Invalid payload or signature', 400
             
+        # Stripe retries deliveries, so skip events we have already handled
+        # (in-process cache first, then the processed_webhooks table)
+        if webhook_event_seen(event['id']):
+            return jsonify(success=True, duplicate=True)
+        if db.session.get(ProcessedWebhook, event['id']):
+            remember_webhook_event(event['id'])
+            return jsonify(success=True, duplicate=True)
+            
         if event['type'] == 'checkout.session.completed':
             session = event['data']['object']
             customer_email = session.get('customer_email')
             if customer_email:
-                user = User.query.filter_by(email=customer_email).first()
+                user = db.session.scalar(USER_BY_EMAIL, {'email': customer_email})
                 if user:
                     # Check payment type from metadata
                     payment_type = session.get('metadata', {}).get('payment_type', 'unknown')
@@ -859,7 +1291,15 @@ def create_app():
                     if session_mode == 'subscription' or payment_type == 'subscription':
                         # Upgrade to the specified tier (pro or enterprise)
                         user.tier = tier
-                        db.session.commit()
+                        # Remember the Stripe customer so a later cancellation maps back without an API call
+                        customer_id = session.get('customer')
+                        if customer_id and user.stripe_customer_id != customer_id:
+                            # The column is unique; a clash must not roll back the tier upgrade
+                            owner = db.session.scalar(USER_BY_STRIPE_CUSTOMER, {'customer_id': customer_id})
+                            if owner is None:
+                                user.stripe_customer_id = customer_id
+                            else:
+                                print(f"Stripe customer {customer_id} already belongs to {owner.email}; not linking it to {customer_email}")
                         print(f"User {customer_email} upgraded to {tier.capitalize()} via subscription")
                     else:
                         # For test payments, just log but don't upgrade
@@ -871,19 +1311,30 @@ def create_app():
             subscription = event['data']['object']
             customer_id = subscription.get('customer')
             if customer_id:
-                # Get customer email from Stripe
                 try:
-                    customer = stripe.Customer.retrieve(customer_id)
-                    customer_email = customer.get('email')
-                    if customer_email:
-                        user = User.query.filter_by(email=customer_email).first()
-                        if user:
-                            # Downgrade to free tier
-                            user.tier = 'free'
-                            db.session.commit()
-                            print(f"User {customer_email} downgraded to Free (subscription cancelled)")
+                    user = db.session.scalar(USER_BY_STRIPE_CUSTOMER, {'customer_id': customer_id})
+                    if user is None:
+                        # Subscribed before customer ids were stored: get the email from Stripe
+                        customer_email = stripe.Customer.retrieve(customer_id).get('email')
+                        if customer_email:
+                            user = db.session.scalar(USER_BY_EMAIL, {'email': customer_email})
+                    if user:
+                        # Downgrade to free tier
+                        user.tier = 'free'
+                        print(f"User {user.email} downgraded to Free (subscription cancelled)")
                 except Exception as e:
                     print(f"Error handling subscription cancellation: {e}")
+        
+        # Record the event and any tier change in one transaction
+        db.session.add(ProcessedWebhook(event_id=event['id']))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent delivery of the same event got there first
+            db.session.rollback()
+            remember_webhook_event(event['id'])
+            return jsonify(success=True, duplicate=True)
+        remember_webhook_event(event['id'])
                     
         return jsonify(success=True)
 
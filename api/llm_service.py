@@ -2,18 +2,119 @@ import boto3
 import json
 from typing import Dict, Optional
 
+_JSON_DECODER = json.JSONDecoder()
+
+# Document text sent to the model is capped by characters and by UTF-8 bytes; bytes track
+# tokens far better than characters for non-Latin scripts (about 4 bytes per token)
+MAX_PROMPT_CHARS = 4000
+MAX_PROMPT_BYTES = 8000
+
+# Prompt pieces are built once at import; _build_prompt only splices in the document text
+_PROMPT_PREFIX = """Analyze the following document text and extract structured information.
+Return your response as valid JSON only, with no additional text.
+
+Document text:
+"""
+
+_PROMPT_SCHEMAS = {
+    'general': """
+Provide a JSON response with:
+{
+  "summary": "Brief 2-3 sentence summary",
+  "key_points": ["point1", "point2", "point3"],
+  "document_type": "detected type (e.g., letter, report, form)",
+  "entities": {
+    "people": [],
+    "organizations": [],
+    "dates": [],
+    "locations": []
+  }
+}""",
+    
+    'invoice': """
+Extract invoice information as JSON:
+{
+  "vendor": "Company name",
+  "invoice_number": "INV-123",
+  "date": "YYYY-MM-DD",
+  "due_date": "YYYY-MM-DD",
+  "total_amount": "123.45",
+  "currency": "USD",
+  "line_items": [
+    {"description": "Item", "quantity": 1, "unit_price": "10.00", "total": "10.00"}
+  ],
+  "tax": "0.00",
+  "subtotal": "123.45"
+}""",
+    
+    'contract': """
+Extract contract information as JSON:
+{
+  "contract_type": "Type of agreement",
+  "parties": ["Party A", "Party B"],
+  "effective_date": "YYYY-MM-DD",
+  "expiration_date": "YYYY-MM-DD",
+  "key_terms": [
+    {"term": "Payment terms", "details": "Net 30"},
+    {"term": "Termination", "details": "30 days notice"}
+  ],
+  "obligations": {
+    "party_a": ["obligation1", "obligation2"],
+    "party_b": ["obligation1", "obligation2"]
+  },
+  "important_clauses": ["clause1", "clause2"]
+}""",
+    
+    'form': """
+Extract form fields as JSON:
+{
+  "form_type": "Type of form",
+  "fields": [
+    {"label": "Name", "value": "John Doe"},
+    {"label": "Date", "value": "2024-01-01"},
+    {"label": "Signature", "value": "Present/Absent"}
+  ],
+  "checkboxes": [
+    {"label": "Option A", "checked": true},
+    {"label": "Option B", "checked": false}
+  ],
+  "completeness": "Complete/Incomplete/Partially Complete"
+}"""
+}
+
+_JSON_TYPES = {str: "string", list: "array", dict: "object", bool: "boolean", int: "number", float: "number"}
+
+
+def _analysis_tool(schema_text: str) -> Dict:
+    """Build the forced tool for one analysis type; its input schema requires every
+    top-level field of the prompt's example JSON, so the model can't return an empty object"""
+    example, _ = _JSON_DECODER.raw_decode(schema_text, schema_text.index('{'))
+    return {
+        "name": "emit_analysis",
+        "description": "Record the structured analysis of the document in the JSON shape requested.",
+        "input_schema": {
+            "type": "object",
+            "properties": {key: {"type": _JSON_TYPES[type(value)]} for key, value in example.items()},
+            "required": list(example)
+        }
+    }
+
+# Forcing the tool makes Claude return the analysis as an already-parsed JSON object
+_ANALYSIS_TOOLS = {name: _analysis_tool(text) for name, text in _PROMPT_SCHEMAS.items()}
+
 
 class LLMAnalyzer:
     """Service for analyzing OCR text using Amazon Bedrock with Claude 3 Haiku"""
     
-    def __init__(self, region_name: str):
+    def __init__(self, region_name: str, session: Optional[boto3.session.Session] = None):
         """
         Initialize the LLM analyzer with Bedrock client
         
         Args:
             region_name: AWS region where Bedrock is available (e.g., 'us-east-1')
+            session: Optional boto3 session to share credentials with other clients
         """
-        self.bedrock = boto3.client('bedrock-runtime', region_name=region_name)
+        self.bedrock = (session or boto3).client('bedrock-runtime', region_name=region_name)
         self.model_id = 'anthropic.claude-3-haiku-20240307-v1:0'
         
     def analyze_document(self, text: str, analysis_type: str) -> Dict:
@@ -28,6 +129,7 @@ class LLMAnalyzer:
             Structured JSON dictionary with analysis results
         """
         prompt = self._build_prompt(text, analysis_type)
+        tool = _ANALYSIS_TOOLS.get(analysis_type, _ANALYSIS_TOOLS['general'])
         
         request_body = {
             "anthropic_version": "bedrock-2023-05-31",
@@ -38,7 +140,9 @@ class LLMAnalyzer:
                     "content": prompt
                 }
             ],
-            "temperature": 0.1  # Low temperature for consistent extraction
+            "temperature": 0.1,  # Low temperature for consistent extraction
+            "tools": [tool],
+            "tool_choice": {"type": "tool", "name": tool["name"]}
         }
         
         try:
@@ -48,9 +152,19 @@ class LLMAnalyzer:
             )
             
             response_body = json.loads(response['body'].read())
-            analysis_text = response_body['content'][0]['text']
+            for block in response_body['content']:
+                if block.get('type') == 'tool_use' and isinstance(block.get('input'), dict):
+                    if not block['input']:
+                        # An empty object is not an analysis; report it so it isn't cached
+                        return {
+                            "error": "Model returned an empty analysis",
+                            "analysis_type": analysis_type
+                        }
+                    # Tool input arrives already parsed; no text scraping needed
+                    return dict(block['input'], analysis_type=analysis_type)
             
-            # Parse JSON from response
+            # Fall back to parsing JSON out of a plain text reply
+            analysis_text = ''.join(block.get('text', '') for block in response_body['content'])
             return self._parse_analysis(analysis_text, analysis_type)
             
         except Exception as e:
@@ -70,84 +184,15 @@ class LLMAnalyzer:
         Returns:
             Formatted prompt string for Claude
         """
-        # Limit text to ~4000 characters to stay within token limits
-        truncated_text = text[:4000]
-        
-        base_instruction = f"""Analyze the following document text and extract structured information.
-Return your response as valid JSON only, with no additional text.
-
-Document text:
-{truncated_text}
-
-"""
-        
-        prompts = {
-            'general': base_instruction + """
-Provide a JSON response with:
-{
-  "summary": "Brief 2-3 sentence summary",
-  "key_points": ["point1", "point2", "point3"],
-  "document_type": "detected type (e.g., letter, report, form)",
-  "entities": {
-    "people": [],
-    "organizations": [],
-    "dates": [],
-    "locations": []
-  }
-}""",
-            
-            'invoice': base_instruction + """
-Extract invoice information as JSON:
-{
-  "vendor": "Company name",
-  "invoice_number": "INV-123",
-  "date": "YYYY-MM-DD",
-  "due_date": "YYYY-MM-DD",
-  "total_amount": "123.45",
-  "currency": "USD",
-  "line_items": [
-    {"description": "Item", "quantity": 1, "unit_price": "10.00", "total": "10.00"}
-  ],
-  "tax": "0.00",
-  "subtotal": "123.45"
-}""",
-            
-            'contract': base_instruction + """
-Extract contract information as JSON:
-{
-  "contract_type": "Type of agreement",
-  "parties": ["Party A", "Party B"],
-  "effective_date": "YYYY-MM-DD",
-  "expiration_date": "YYYY-MM-DD",
-  "key_terms": [
-    {"term": "Payment terms", "details": "Net 30"},
-    {"term": "Termination", "details": "30 days notice"}
-  ],
-  "obligations": {
-    "party_a": ["obligation1", "obligation2"],
-    "party_b": ["obligation1", "obligation2"]
-  },
-  "important_clauses": ["clause1", "clause2"]
-}""",
-            
-            'form': base_instruction + """
-Extract form fields as JSON:
-{
-  "form_type": "Type of form",
-  "fields": [
-    {"label": "Name", "value": "John Doe"},
-    {"label": "Date", "value": "2024-01-01"},
-    {"label": "Signature", "value": "Present/Absent"}
-  ],
-  "checkboxes": [
-    {"label": "Option A", "checked": true},
-    {"label": "Option B", "checked": false}
-  ],
-  "completeness": "Complete/Incomplete/Partially Complete"
-}"""
-        }
+        # Limit text to ~4000 characters / 8000 bytes to stay within token limits
+        truncated_text = text[:MAX_PROMPT_CHARS]
+        encoded = truncated_text.encode('utf-8')
+        if len(encoded) > MAX_PROMPT_BYTES:
+            # Drop any multi-byte character split by the cut
+            truncated_text = encoded[:MAX_PROMPT_BYTES].decode('utf-8', 'ignore')
         
-        return prompts.get(analysis_type, prompts['general'])
+        schema = _PROMPT_SCHEMAS.get(analysis_type, _PROMPT_SCHEMAS['general'])
+        return _PROMPT_PREFIX + truncated_text + "\n\n" + schema
     
     def _parse_analysis(self, analysis_text: str, analysis_type: str) -> Dict:
         """
@@ -161,13 +206,12 @@ Extract form fields as JSON:
             Parsed JSON dictionary or error dictionary
         """
         try:
-            # Extract JSON from response (Claude might add explanation text)
+            # Extract JSON from response (Claude might add explanation text);
+            # raw_decode stops at the end of the first object, so trailing prose is ignored
             start = analysis_text.find('{')
-            end = analysis_text.rfind('}') + 1
             
-            if start != -1 and end > start:
-                json_str = analysis_text[start:end]
-                parsed_result = json.loads(json_str)
+            if start != -1:
+                parsed_result, _ = _JSON_DECODER.raw_decode(analysis_text, start)
                 
                 # Add metadata
                 parsed_result['analysis_type'] = analysis_type
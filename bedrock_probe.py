@@ -0,0 +1,41 @@
+"""
+Shared Bedrock helpers for test_bedrock_connection.py and test_bedrock_simple.py.
+Clients come from one lazily created boto3 session, so a process that runs
+several checks only pays for credential resolution and client setup once.
+"""
+
+import json
+from functools import lru_cache
+
+# Claude 3 Haiku, the model api/llm_service.py invokes
+MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
+
+# Fail fast on unreachable endpoints, keep sockets alive between calls and back off on throttling
+CLIENT_OPTIONS = {
+    'connect_timeout': 3,
+    'read_timeout': 30,
+    'tcp_keepalive': True,
+    'retries': {'max_attempts': 5, 'mode': 'adaptive'}
+}
+
+@lru_cache(maxsize=1)
+def get_session():
+    """One session resolves credentials and loads endpoint data once for every client"""
+    # boto3 is imported on first use so a failed credential check exits without loading it
+    import boto3
+    return boto3.session.Session()
+
+@lru_cache(maxsize=None)
+def get_client(service, region):
+    """Return a shared client for the service and region"""
+    from botocore.config import Config
+    return get_session().client(service, region_name=region, config=Config(**CLIENT_OPTIONS))
+
+def invoke(region, body):
+    """Invoke MODEL_ID with a serialized request body, returning (text, usage)"""
+    response = get_client('bedrock-runtime', region).invoke_model(
+        modelId=MODEL_ID,
+        body=body
+    )
+    response_body = json.loads(response['body'].read())
+    return response_body['content'][0]['text'], response_body.get('usage', {})
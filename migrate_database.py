@@ -16,93 +16,91 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 print("🔄 Starting database migration...")
 print(f"Database: {DATABASE_URL.split('@')[1].split('/')[0] if '@' in DATABASE_URL else 'local'}")
 
+conn = cur = None
 try:
     # Connect to database
     conn = psycopg2.connect(DATABASE_URL)
     cur = conn.cursor()
     
-    print("\n1️⃣ Checking existing schema...")
-    
-    # Check if llm_analyses_this_month column exists
+    print("\n1️⃣ Checking users columns...")
     cur.execute("""
-        SELECT column_name 
-        FROM information_schema.columns 
-        WHERE table_name='users' AND column_name='llm_analyses_this_month'
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS llm_analyses_this_month INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS api_key VARCHAR(64) UNIQUE;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS api_key_created TIMESTAMP;
     """)
+    print("   ✅ llm_analyses_this_month, api_key, api_key_created present")
     
-    if cur.fetchone() is None:
-        print("   Adding llm_analyses_this_month column...")
-        cur.execute("""
-            ALTER TABLE users 
-            ADD COLUMN llm_analyses_this_month INTEGER NOT NULL DEFAULT 0
-        """)
-        print("   ✅ Added llm_analyses_this_month")
-    else:
-        print("   ✅ llm_analyses_this_month already exists")
+    print("\n2️⃣ Checking document_history table...")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS document_history (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            filename VARCHAR(255) NOT NULL,
+            upload_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            analysis_type VARCHAR(50),
+            textract_job_id VARCHAR(100) NOT NULL,
+            csv_filename VARCHAR(255) NOT NULL,
+            json_filename VARCHAR(255),
+            file_size INTEGER NOT NULL,
+            page_count INTEGER,
+            processing_cost FLOAT
+        )
+    """)
+    print("   ✅ document_history table present")
     
-    # Check if api_key column exists
+    print("\n3️⃣ Checking processed_webhooks table...")
     cur.execute("""
-        SELECT column_name 
-        FROM information_schema.columns 
-        WHERE table_name='users' AND column_name='api_key'
+        CREATE TABLE IF NOT EXISTS processed_webhooks (
+            event_id VARCHAR(255) PRIMARY KEY,
+            received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
     """)
+    print("   ✅ processed_webhooks table present")
     
-    if cur.fetchone() is None:
-        print("   Adding api_key column...")
-        cur.execute("""
-            ALTER TABLE users 
-            ADD COLUMN api_key VARCHAR(64) UNIQUE
-        """)
-        print("   ✅ Added api_key")
-    else:
-        print("   ✅ api_key already exists")
+    # Let Postgres fill in timestamps instead of the app
+    print("\n4️⃣ Setting server-side timestamp defaults...")
+    for table, column in (('users', 'usage_reset_date'),
+                          ('document_history', 'upload_date'),
+                          ('processed_webhooks', 'received_at')):
+        cur.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN {} SET DEFAULT (now() at time zone 'utc')").format(
+            sql.Identifier(table), sql.Identifier(column)))
+        print(f"   ✅ {table}.{column} defaults to now() (UTC)")
     
-    # Check if api_key_created column exists
+    print("\n5️⃣ Checking document_history indexes...")
     cur.execute("""
-        SELECT column_name 
-        FROM information_schema.columns 
-        WHERE table_name='users' AND column_name='api_key_created'
+        CREATE INDEX IF NOT EXISTS ix_document_history_user_upload
+        ON document_history (user_id, upload_date DESC)
     """)
+    print("   ✅ ix_document_history_user_upload present")
     
-    if cur.fetchone() is None:
-        print("   Adding api_key_created column...")
-        cur.execute("""
-            ALTER TABLE users 
-            ADD COLUMN api_key_created TIMESTAMP
-        """)
-        print("   ✅ Added api_key_created")
-    else:
-        print("   ✅ api_key_created already exists")
-    
-    # Check if document_history table exists
-    print("\n2️⃣ Checking document_history table...")
+    print("\n6️⃣ Checking llm_results table...")
     cur.execute("""
-        SELECT EXISTS (
-            SELECT FROM information_schema.tables 
-            WHERE table_name = 'document_history'
+        CREATE TABLE IF NOT EXISTS llm_results (
+            cache_key VARCHAR(64) PRIMARY KEY,
+            analysis TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
         )
     """)
+    print("   ✅ llm_results table present")
     
-    if not cur.fetchone()[0]:
-        print("   Creating document_history table...")
-        cur.execute("""
-            CREATE TABLE document_history (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                filename VARCHAR(255) NOT NULL,
-                upload_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                analysis_type VARCHAR(50),
-                textract_job_id VARCHAR(100) NOT NULL,
-                csv_filename VARCHAR(255) NOT NULL,
-                json_filename VARCHAR(255),
-                file_size INTEGER NOT NULL,
-                page_count INTEGER,
-                processing_cost FLOAT
-            )
-        """)
-        print("   ✅ Created document_history table")
-    else:
-        print("   ✅ document_history table already exists")
+    print("\n7️⃣ Checking stripe_customer_id column...")
+    cur.execute("""
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS stripe_customer_id VARCHAR(255)
+    """)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_users_stripe_customer_id ON users (stripe_customer_id)
+    """)
+    print("   ✅ stripe_customer_id present")
+    
+    print("\n8️⃣ Checking textract_jobs table...")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS textract_jobs (
+            job_id VARCHAR(100) PRIMARY KEY,
+            status VARCHAR(20) NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
+        )
+    """)
+    print("   ✅ textract_jobs table present")
     
     # Commit all changes
     conn.commit()
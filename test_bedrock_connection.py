@@ -10,60 +10,65 @@ Usage:
 import os
 import sys
 import json
-import boto3
 from dotenv import load_dotenv
+from bedrock_probe import MODEL_ID, get_client, invoke
 
 # Load environment variables
 load_dotenv()
 
+# --- ENVIRONMENT (read once, shared by every check) ---
+AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
+AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
+AWS_REGION = os.environ.get('AWS_REGION') or 'us-east-1'
+S3_BUCKET = os.environ.get('S3_BUCKET')
+
+# Simple test prompt, serialized once
+INVOKE_BODY = json.dumps({
+    "anthropic_version": "bedrock-2023-05-31",
+    "max_tokens": 100,
+    "messages": [
+        {
+            "role": "user",
+            "content": "Say 'Hello, Bedrock!' and nothing else."
+        }
+    ],
+    "temperature": 0.1
+})
+
 def test_aws_credentials():
     """Test that AWS credentials are configured"""
     print("🔍 Testing AWS credentials...")
     
-    access_key = os.environ.get('AWS_ACCESS_KEY_ID')
-    secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
-    region = os.environ.get('AWS_REGION')
-    
-    if not access_key or not secret_key:
+    if not AWS_ACCESS_KEY_ID or not AWS_SECRET_ACCESS_KEY:
         print("❌ AWS credentials not found in environment variables")
         print("   Please set AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY in .env file")
         return False
     
-    if not region:
+    if not os.environ.get('AWS_REGION'):
         print("⚠️  AWS_REGION not set, defaulting to us-east-1")
-        region = 'us-east-1'
     
     print(f"✅ AWS credentials found")
-    print(f"   Region: {region}")
-    print(f"   Access Key: {access_key[:10]}...")
+    print(f"   Region: {AWS_REGION}")
+    print(f"   Access Key: {AWS_ACCESS_KEY_ID[:10]}...")
     return True
 
 def test_bedrock_access():
     """Test Bedrock API access"""
     print("\n🔍 Testing Amazon Bedrock access...")
     
-    region = os.environ.get('AWS_REGION', 'us-east-1')
-    
     try:
-        bedrock = boto3.client('bedrock', region_name=region)
-        
-        # List foundation models
-        response = bedrock.list_foundation_models(byProvider='anthropic')
-        
-        models = response.get('modelSummaries', [])
-        print(f"✅ Successfully connected to Bedrock in {region}")
-        print(f"   Found {len(models)} Anthropic models")
+        bedrock = get_client('bedrock', AWS_REGION)
         
-        # Check for Claude 3 Haiku
-        haiku_model = None
-        for model in models:
-            if 'claude-3-haiku' in model['modelId']:
-                haiku_model = model
-                break
+        # Look up the one model the app uses rather than listing the whole catalog
+        try:
+            model = bedrock.get_foundation_model(modelIdentifier=MODEL_ID)['modelDetails']
+        except (bedrock.exceptions.ResourceNotFoundException, bedrock.exceptions.ValidationException):
+            model = None
+        print(f"✅ Successfully connected to Bedrock in {AWS_REGION}")
         
-        if haiku_model:
+        if model:
             print(f"✅ Claude 3 Haiku is available")
-            print(f"   Model ID: {haiku_model['modelId']}")
+            print(f"   Model ID: {model['modelId']}")
         else:
             print("⚠️  Claude 3 Haiku not found in available models")
             print("   You may need to enable model access in the Bedrock console")
@@ -74,7 +79,7 @@ def test_bedrock_access():
         print(f"❌ Failed to connect to Bedrock: {str(e)}")
         print("\n   Possible solutions:")
         print("   1. Enable Bedrock model access in AWS Console")
-        print("   2. Verify IAM permissions include bedrock:ListFoundationModels")
+        print("   2. Verify IAM permissions include bedrock:GetFoundationModel")
         print("   3. Check that your region supports Bedrock")
         print("   4. Supported regions: us-east-1, us-west-2, ap-southeast-1, eu-central-1")
         return False
@@ -83,37 +88,13 @@ def test_bedrock_invoke():
     """Test invoking Claude 3 Haiku model"""
     print("\n🔍 Testing Claude 3 Haiku invocation...")
     
-    region = os.environ.get('AWS_REGION', 'us-east-1')
-    model_id = 'anthropic.claude-3-haiku-20240307-v1:0'
-    
     try:
-        bedrock_runtime = boto3.client('bedrock-runtime', region_name=region)
-        
-        # Simple test prompt
-        request_body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 100,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": "Say 'Hello, Bedrock!' and nothing else."
-                }
-            ],
-            "temperature": 0.1
-        }
-        
-        response = bedrock_runtime.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-        
-        response_body = json.loads(response['body'].read())
-        response_text = response_body['content'][0]['text']
+        response_text, usage = invoke(AWS_REGION, INVOKE_BODY)
         
         print(f"✅ Successfully invoked Claude 3 Haiku")
         print(f"   Response: {response_text}")
-        print(f"   Input tokens: {response_body.get('usage', {}).get('input_tokens', 'N/A')}")
-        print(f"   Output tokens: {response_body.get('usage', {}).get('output_tokens', 'N/A')}")
+        print(f"   Input tokens: {usage.get('input_tokens', 'N/A')}")
+        print(f"   Output tokens: {usage.get('output_tokens', 'N/A')}")
         
         return True
         
@@ -140,20 +121,17 @@ def test_s3_access():
     """Test S3 bucket access"""
     print("\n🔍 Testing S3 bucket access...")
     
-    bucket = os.environ.get('S3_BUCKET')
-    region = os.environ.get('AWS_REGION', 'us-east-1')
-    
-    if not bucket:
+    if not S3_BUCKET:
         print("⚠️  S3_BUCKET not set in environment variables")
         return False
     
     try:
-        s3 = boto3.client('s3', region_name=region)
+        s3 = get_client('s3', AWS_REGION)
         
         # Try to list objects (will work even if bucket is empty)
-        s3.list_objects_v2(Bucket=bucket, MaxKeys=1)
+        s3.list_objects_v2(Bucket=S3_BUCKET, MaxKeys=1)
         
-        print(f"✅ Successfully accessed S3 bucket: {bucket}")
+        print(f"✅ Successfully accessed S3 bucket: {S3_BUCKET}")
         return True
         
     except Exception as e:
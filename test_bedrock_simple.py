@@ -3,20 +3,16 @@
 
 import os
 import json
-import boto3
 from dotenv import load_dotenv
+from bedrock_probe import MODEL_ID, invoke
 
 load_dotenv()
 
-region = os.environ.get('AWS_REGION', 'us-east-1')
+region = os.environ.get('AWS_REGION') or 'us-east-1'
 print(f"Testing Bedrock in region: {region}")
 
 try:
     # Try to invoke with minimal request
-    bedrock_runtime = boto3.client('bedrock-runtime', region_name=region)
-    
-    model_id = 'anthropic.claude-3-haiku-20240307-v1:0'
-    
     request_body = {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": 50,
@@ -28,16 +24,11 @@ try:
         ]
     }
     
-    print(f"Attempting to invoke: {model_id}")
-    
-    response = bedrock_runtime.invoke_model(
-        modelId=model_id,
-        body=json.dumps(request_body)
-    )
+    print(f"Attempting to invoke: {MODEL_ID}")
     
-    response_body = json.loads(response['body'].read())
+    response_text, _ = invoke(region, json.dumps(request_body))
     print("✅ SUCCESS!")
-    print(f"Response: {response_body['content'][0]['text']}")
+    print(f"Response: {response_text}")
     
 except Exception as e:
     print(f"❌ ERROR: {str(e)}")